@@ -26,6 +26,16 @@ from tensorflow.python.tools.inspect_checkpoint import print_tensors_in_checkpoi
 
 
 # Loss functions.
+@torch.jit.script
+def _pytorch_quantile_loss(y, y_pred, quantile: float):
+  """Scripted body of pytorch_quantile_loss so the elementwise ops fuse."""
+  prediction_underflow = y - y_pred
+  q_loss = quantile * torch.clamp(prediction_underflow, min=0.) + (
+      1. - quantile) * torch.clamp(-prediction_underflow, min=0.)
+
+  return torch.sum(q_loss, dim=-1)
+
+
 def pytorch_quantile_loss(y, y_pred, quantile):
   """Computes quantile loss for tensorflow.
 
@@ -47,11 +57,7 @@ def pytorch_quantile_loss(y, y_pred, quantile):
         'Illegal quantile value={}! Values should be between 0 and 1.'.format(
             quantile))
 
-  prediction_underflow = y - y_pred
-  q_loss = quantile * torch.max(prediction_underflow, torch.zeros_like(prediction_underflow)) + (
-      1. - quantile) * torch.max(-prediction_underflow, torch.zeros_like(prediction_underflow))
-
-  return torch.sum(q_loss, axis=-1)
+  return _pytorch_quantile_loss(y, y_pred, float(quantile))
 
 
 
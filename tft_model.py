@@ -4,10 +4,18 @@ Implementation of Temporal Fusion Transformers: https://arxiv.org/abs/1912.09363
 
 
 from torch import nn
+import torch.nn.functional as F
+from typing import Optional
+import copy
 import math
 import torch
 import ipdb
 
+def batch_to_device(batch, device, non_blocking=True):
+    ## Moves every tensor of a batch dict to device in one go, outside of the model's forward
+    ## Use with DataLoader(pin_memory=True) so the host to device copies are asynchronous
+    return {k: v.to(device, non_blocking=non_blocking) if torch.is_tensor(v) else v for k, v in batch.items()}
+
 class QuantileLoss(nn.Module):
     ## From: https://medium.com/the-artificial-impostor/quantile-regression-part-2-6fdbc26b2629
 
@@ -31,31 +39,14 @@ class QuantileLoss(nn.Module):
             torch.sum(torch.cat(losses, dim=1), dim=1))
         return loss
 
-class TimeDistributed(nn.Module):
-    ## Takes any module and stacks the time dimension with the batch dimenison of inputs before apply the module
-    ## From: https://discuss.pytorch.org/t/any-pytorch-function-can-work-as-keras-timedistributed/1346/4
-    def __init__(self, module, batch_first=False):
-        super(TimeDistributed, self).__init__()
-        self.module = module
-        self.batch_first = batch_first
-
-    def forward(self, x):
-
-        if len(x.size()) <= 2:
-            return self.module(x)
-
-        # Squash samples and timesteps into a single axis
-        x_reshape = x.contiguous().view(-1, x.size(-1))  # (samples * timesteps, input_size)
-
-        y = self.module(x_reshape)
-
-        # We have to reshape Y
-        if self.batch_first:
-            y = y.contiguous().view(x.size(0), -1, y.size(-1))  # (samples, timesteps, output_size)
-        else:
-            y = y.view(-1, x.size(1), y.size(-1))  # (timesteps, samples, output_size)
-
-        return y
+@torch.jit.script
+def gated_residual(gate, x, residual: Optional[torch.Tensor] = None):
+    ## sigmoid(gate) * x (+ residual), scripted so the pointwise ops fuse into one kernel
+    ## (the fuser kicks in after the first couple of calls with a given input shape)
+    x = torch.sigmoid(gate) * x
+    if residual is not None:
+        x = x + residual
+    return x
 
 class GLU(nn.Module):
     #Gated Linear Unit
@@ -64,17 +55,14 @@ class GLU(nn.Module):
         
         self.fc1 = nn.Linear(input_size,input_size)
         self.fc2 = nn.Linear(input_size, input_size)
-        self.sigmoid = nn.Sigmoid()
-        
-    def forward(self, x):
         
-        sig = self.sigmoid(self.fc1(x))
-        x = self.fc2(x)
-        return torch.mul(sig, x)
+    def forward(self, x, residual=None):
+        ##residual, if given, is added to the gated output as part of the same fused kernel
+        return gated_residual(self.fc1(x), self.fc2(x), residual)
 
 
 class GatedResidualNetwork(nn.Module):
-    def __init__(self, input_size,hidden_state_size, output_size, dropout, hidden_context_size=None, batch_first=False):
+    def __init__(self, input_size,hidden_state_size, output_size, dropout, hidden_context_size=None):
         super(GatedResidualNetwork, self).__init__()
         self.input_size = input_size
         self.output_size = output_size
@@ -83,20 +71,20 @@ class GatedResidualNetwork(nn.Module):
         self.dropout = dropout
         
         if self.input_size!=self.output_size:
-            self.skip_layer = TimeDistributed(nn.Linear(self.input_size, self.output_size))
+            self.skip_layer = nn.Linear(self.input_size, self.output_size)
 
-        self.fc1 = TimeDistributed(nn.Linear(self.input_size, self.hidden_state_size), batch_first=batch_first)
+        self.fc1 = nn.Linear(self.input_size, self.hidden_state_size)
         self.elu1 = nn.ELU()
         
         if self.hidden_context_size is not None:
-            self.context = TimeDistributed(nn.Linear(self.hidden_context_size, self.hidden_state_size),batch_first=batch_first)
+            self.context = nn.Linear(self.hidden_context_size, self.hidden_state_size)
             
-        self.fc2 = TimeDistributed(nn.Linear(self.hidden_state_size,  self.output_size), batch_first=batch_first)
+        self.fc2 = nn.Linear(self.hidden_state_size,  self.output_size)
         self.elu2 = nn.ELU()
         
         self.dropout = nn.Dropout(self.dropout)
-        self.bn = TimeDistributed(nn.BatchNorm1d(self.output_size),batch_first=batch_first)
-        self.gate = TimeDistributed(GLU(self.output_size), batch_first=batch_first)
+        self.ln = nn.LayerNorm(self.output_size)
+        self.gate = GLU(self.output_size)
 
     def forward(self, x, context=None):
 
@@ -113,9 +101,8 @@ class GatedResidualNetwork(nn.Module):
         
         x = self.fc2(x)
         x = self.dropout(x)
-        x = self.gate(x)
-        x = x+residual
-        x = self.bn(x)
+        x = self.gate(x, residual)
+        x = self.ln(x)
         
         return x
 
@@ -141,6 +128,44 @@ class PositionalEncoder(torch.nn.Module):
             x = x + pe
             return x
 
+class MultiHeadAttention(nn.Module):
+    ## Batch-first multi-head attention built on F.scaled_dot_product_attention, which dispatches to the fused
+    ## (flash / memory efficient) kernels when they are available
+    def __init__(self, hidden_size, num_heads):
+        super(MultiHeadAttention, self).__init__()
+        assert hidden_size % num_heads == 0, 'hidden_size must be divisible by num_heads'
+        self.hidden_size = hidden_size
+        self.num_heads = num_heads
+        self.head_size = hidden_size // num_heads
+
+        self.q_proj = nn.Linear(self.hidden_size, self.hidden_size)
+        ##keys and values are projected from the same memory, so both come out of one GEMM
+        self.kv_proj = nn.Linear(self.hidden_size, 2*self.hidden_size)
+        self.out_proj = nn.Linear(self.hidden_size, self.hidden_size)
+
+    def split_heads(self, x):
+        ##(batch, timesteps, hidden) -> (batch, heads, timesteps, head_size)
+        return x.view(x.size(0), x.size(1), self.num_heads, self.head_size).transpose(1, 2)
+
+    def forward(self, query, memory, need_weights=True):
+        q = self.split_heads(self.q_proj(query))
+        kv = self.kv_proj(memory).view(memory.size(0), memory.size(1), 2, self.num_heads, self.head_size)
+        k, v = [t.transpose(1, 2) for t in kv.unbind(2)]
+
+        if need_weights:
+            ##the fused kernels do not expose the attention matrix, so compute it explicitly when it is asked for
+            attn_output_weights = torch.softmax(torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(self.head_size), dim=-1)
+            attn_output = torch.matmul(attn_output_weights, v)
+            ##average over heads, as nn.MultiheadAttention does
+            attn_output_weights = attn_output_weights.mean(dim=1)
+        else:
+            attn_output = F.scaled_dot_product_attention(q, k, v)
+            attn_output_weights = None
+
+        attn_output = attn_output.transpose(1, 2).reshape(query.size(0), query.size(1), self.hidden_size)
+
+        return self.out_proj(attn_output), attn_output_weights
+
 class VariableSelectionNetwork(nn.Module):
     def __init__(self, input_size, num_inputs, hidden_size, dropout, context=None):
         super(VariableSelectionNetwork, self).__init__()
@@ -161,7 +186,7 @@ class VariableSelectionNetwork(nn.Module):
         for i in range(self.num_inputs):
             self.single_variable_grns.append(GatedResidualNetwork(self.input_size, self.hidden_size, self.hidden_size, self.dropout))
 
-        self.softmax = nn.Softmax()
+        self.softmax = nn.Softmax(dim=-1)
 
     def forward(self, embedding, context=None):
         if context is not None:
@@ -205,23 +230,26 @@ class TFT(nn.Module):
         self.num_quantiles = config['num_quantiles']
         self.valid_quantiles = config['vailid_quantiles']
         self.seq_length = config['seq_length']
+        self.use_autocast = config.get('use_autocast', True)
         
-        self.static_embedding_layers = nn.ModuleList()
-        for i in range(self.static_variables):
-            emb = nn.Embedding(config['static_embedding_vocab_sizes'][i], config['embedding_dim']).to(self.device)
-            self.static_embedding_layers.append(emb)
+        ##single table shared by all static variables, each variable's ids are shifted by its offset
+        static_vocab_sizes = config['static_embedding_vocab_sizes'][:self.static_variables]
+        self.static_embedding = nn.Embedding(sum(static_vocab_sizes), config['embedding_dim'])
+        self.register_buffer('static_embedding_offsets', torch.tensor([0] + static_vocab_sizes[:-1]).cumsum(0), persistent=False)
         
         
         
-        self.time_varying_embedding_layers = nn.ModuleList()
-        for i in range(self.time_varying_categoical_variables):
-            emb = TimeDistributed(nn.Embedding(config['time_varying_embedding_vocab_sizes'][i], config['embedding_dim']), batch_first=True).to(self.device)
-            self.time_varying_embedding_layers.append(emb)
+        ##single table shared by all time-varying categorical variables, each variable's ids are shifted by its offset
+        time_varying_vocab_sizes = config['time_varying_embedding_vocab_sizes'][:self.time_varying_categoical_variables]
+        self.time_varying_embedding = nn.Embedding(sum(time_varying_vocab_sizes), config['embedding_dim'])
+        self.register_buffer('time_varying_embedding_offsets', torch.tensor([0] + time_varying_vocab_sizes[:-1]).cumsum(0), persistent=False)
             
-        self.time_varying_linear_layers = nn.ModuleList()
-        for i in range(self.time_varying_real_variables_encoder):
-            emb = TimeDistributed(nn.Linear(1, config['embedding_dim']), batch_first=True).to(self.device)
-            self.time_varying_linear_layers.append(emb)
+        ##one (weight, bias) row per time-varying real variable, equivalent to a bank of nn.Linear(1, embedding_dim)
+        self.time_varying_linear_weight = nn.Parameter(torch.empty(self.time_varying_real_variables_encoder, config['embedding_dim']))
+        self.time_varying_linear_bias = nn.Parameter(torch.empty(self.time_varying_real_variables_encoder, config['embedding_dim']))
+        ##same initialisation as nn.Linear with fan_in=1
+        nn.init.uniform_(self.time_varying_linear_weight, -1, 1)
+        nn.init.uniform_(self.time_varying_linear_bias, -1, 1)
 
         self.encoder_variable_selection = VariableSelectionNetwork(config['embedding_dim'],
                                 (config['time_varying_real_variables_encoder'] +  config['time_varying_categoical_variables']),
@@ -245,153 +273,233 @@ class TFT(nn.Module):
                                                         config['static_variables'])
                                       
 
-        self.lstm_encoder = nn.LSTM(input_size=self.hidden_size, 
+        ##the decoder steps are fed known inputs rather than its own predictions, so one LSTM runs over
+        ##the encoder and decoder steps in a single call
+        self.lstm = nn.LSTM(input_size=self.hidden_size, 
                             hidden_size=self.hidden_size,
                            num_layers=self.lstm_layers,
-                           dropout=config['dropout'])
-        
-        self.lstm_decoder = nn.LSTM(input_size=self.hidden_size,
-                                   hidden_size=self.hidden_size,
-                                   num_layers=self.lstm_layers,
-                                   dropout=config['dropout'])
+                           dropout=config['dropout'],
+                           batch_first=True)
+
+        ##zero initial state shared by every forward; nn.LSTM never writes to the state it is given
+        self.register_buffer('_h0', torch.zeros(self.lstm_layers, self.batch_size, self.hidden_size), persistent=False)
 
-        self.post_lstm_gate = TimeDistributed(GLU(self.hidden_size))
-        self.post_lstm_norm = TimeDistributed(nn.BatchNorm1d(self.hidden_size))
+        self.post_lstm_gate = GLU(self.hidden_size)
+        self.post_lstm_norm = nn.LayerNorm(self.hidden_size)
 
         self.static_enrichment = GatedResidualNetwork(self.hidden_size,self.hidden_size, self.hidden_size, self.dropout, config['embedding_dim']*self.static_variables)
         
         self.position_encoding = PositionalEncoder(self.hidden_size, self.seq_length)
 
-        self.multihead_attn = nn.MultiheadAttention(self.hidden_size, self.attn_heads)
-        self.post_attn_gate = TimeDistributed(GLU(self.hidden_size))
+        self.multihead_attn = MultiHeadAttention(self.hidden_size, self.attn_heads)
+        self.post_attn_gate = GLU(self.hidden_size)
 
-        self.post_attn_norm = TimeDistributed(nn.BatchNorm1d(self.hidden_size, self.hidden_size))
+        self.post_attn_norm = nn.LayerNorm(self.hidden_size)
         self.pos_wise_ff = GatedResidualNetwork(self.hidden_size, self.hidden_size, self.hidden_size, self.dropout)
 
-        self.pre_output_norm = TimeDistributed(nn.BatchNorm1d(self.hidden_size, self.hidden_size))
-        self.pre_output_gate = TimeDistributed(GLU(self.hidden_size))
+        self.pre_output_norm = nn.LayerNorm(self.hidden_size)
+        self.pre_output_gate = GLU(self.hidden_size)
+
+        self.output_layer = nn.Linear(self.hidden_size, self.num_quantiles)
 
-        self.output_layer = TimeDistributed(nn.Linear(self.hidden_size, self.num_quantiles), batch_first=True)
+        self.to(self.device)
         
     def init_hidden(self):
-        return torch.zeros(self.lstm_layers, self.batch_size, self.hidden_size, device=self.device)
-        
-    def apply_embedding(self, x, static_embedding, apply_masking):
+        return self._h0
+
+    def quantize_dynamic(self, dtype=torch.qint8):
+        ## Returns a copy of the model for CPU inference with the LSTM and Linear weights stored as int8
+        ## Activations stay float and are quantized on the fly inside each layer, so no calibration is needed
+        ##seed the deepcopy with CPU copies of every parameter and buffer, so a CUDA model is copied straight to the CPU
+        ##instead of being duplicated on the GPU first
+        memo = {}
+        for t in list(self.parameters()) + list(self.buffers()):
+            cpu_t = t.detach().to('cpu', copy=True)
+            memo[id(t)] = nn.Parameter(cpu_t, requires_grad=t.requires_grad) if isinstance(t, nn.Parameter) else cpu_t
+        model = copy.deepcopy(self, memo).eval()
+        model.device = 'cpu'
+        return torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=dtype, inplace=True)
+
+    def autocast_enabled(self):
+        ## bf16 autocast only pays off with native bf16 support (Ampere, compute capability 8.0, and newer);
+        ## older GPUs would either reject it or emulate it more slowly than float32
+        device = self._h0.device
+        return self.use_autocast and device.type == 'cuda' and torch.cuda.get_device_capability(device) >= (8, 0)
+
+    def compile_forward(self, mode='reduce-overhead'):
+        ## Returns a torch.compile'd wrapper of the model
+        ## Dynamo cannot trace nn.LSTM, so the LSTM runs eagerly; embed_inputs and decode_outputs on either side of it
+        ## each compile to a single fused graph
+        ## The wrapper shares this model's parameters; the model itself is left uncompiled, so it can still be
+        ## copied, pickled or passed to quantize_dynamic
+        ## Batch size and sequence lengths are fixed by the config, so compile for static shapes
+        ## The first call with each need_weights / train-eval combination pays the compile cost
+        return torch.compile(self, dynamic=False, mode=mode)
+        
+    def apply_embedding(self, x, apply_masking):
         ###x should have dimensions (batch_size, timesteps, input_size)
         ## Apply masking is used to mask variables that should not be accessed after the encoding steps
         #Time-varying real embeddings 
         if apply_masking:
-            time_varying_real_vectors = []
-            for i in range(self.time_varying_real_variables_decoder):
-                emb = self.time_varying_linear_layers[i+self.num_input_series_to_mask](x[:,:,i+self.num_input_series_to_mask].view(x.size(0), -1, 1))
-                time_varying_real_vectors.append(emb)
-            time_varying_real_embedding = torch.cat(time_varying_real_vectors, dim=2)
-
-        else: 
-            time_varying_real_vectors = []
-            for i in range(self.time_varying_real_variables_encoder):
-                emb = self.time_varying_linear_layers[i](x[:,:,i].view(x.size(0), -1, 1))
-                time_varying_real_vectors.append(emb)
-            time_varying_real_embedding = torch.cat(time_varying_real_vectors, dim=2)
+            first_real = self.num_input_series_to_mask
+            num_real = self.time_varying_real_variables_decoder
+        else:
+            first_real = 0
+            num_real = self.time_varying_real_variables_encoder
+        ##bias + x * weight for every variable at once, as a single broadcast kernel
+        time_varying_real_embedding = torch.addcmul(self.time_varying_linear_bias[first_real:first_real+num_real],
+                                                    x[:,:,first_real:first_real+num_real].unsqueeze(-1),
+                                                    self.time_varying_linear_weight[first_real:first_real+num_real])
+        time_varying_real_embedding = time_varying_real_embedding.reshape(x.size(0), x.size(1), -1)
         
         
          ##Time-varying categorical embeddings (ie hour)
-        time_varying_categoical_vectors = []
-        for i in range(self.time_varying_categoical_variables):
-            emb = self.time_varying_embedding_layers[i](x[:, :,self.time_varying_real_variables_encoder+i].view(x.size(0), -1, 1).long())
-            time_varying_categoical_vectors.append(emb)
-        time_varying_categoical_embedding = torch.cat(time_varying_categoical_vectors, dim=2)  
-
-        ##repeat static_embedding for all timesteps
-        static_embedding = torch.cat(time_varying_categoical_embedding.size(1)*[static_embedding])
-        static_embedding = static_embedding.view(time_varying_categoical_embedding.size(0),time_varying_categoical_embedding.size(1),-1 )
-        
+        time_varying_categoical_ids = x[:,:,self.time_varying_real_variables_encoder:self.time_varying_real_variables_encoder+self.time_varying_categoical_variables].long()
+        time_varying_categoical_embedding = self.time_varying_embedding(time_varying_categoical_ids + self.time_varying_embedding_offsets)
+        time_varying_categoical_embedding = time_varying_categoical_embedding.reshape(x.size(0), x.size(1), -1)
+
         ##concatenate all embeddings
-        embeddings = torch.cat([static_embedding,time_varying_categoical_embedding,time_varying_real_embedding], dim=2)
-        
-        return embeddings.view(-1,x.size(0),embeddings.size(2))
-    
-    def encode(self, x, hidden=None):
-    
-        if hidden is None:
-            hidden = self.init_hidden()
-            
-        output, (hidden, cell) = self.lstm_encoder(x, (hidden, hidden))
-        
-        return output, hidden
-        
-    def decode(self, x, hidden=None):
+        embeddings = torch.cat([time_varying_categoical_embedding,time_varying_real_embedding], dim=2)
         
-        if hidden is None:
-            hidden = self.init_hidden()
-            
-        output, (hidden, cell) = self.lstm_decoder(x, (hidden,hidden))
-        
-        return output, hidden
+        return embeddings
     
 
-    def forward(self, x):
-
+    def embed_inputs(self, x, autocast_enabled):
+        ##everything before the LSTM: static and time-varying embeddings, variable selection and positional encoding
         ##inputs should be in this order
             # static
             # time_varying_categorical
             # time_varying_real
 
-        embedding_vectors = []
-        for i in range(self.static_variables):
-            #only need static variable from the first timestep
-            emb = self.static_embedding_layers[i](x['identifier'][:,0, i].long().to(self.device))
-            embedding_vectors.append(emb)
+        #only need static variable from the first timestep
+        static_ids = x['identifier'][:,0,:self.static_variables].long()
+        static_embedding = self.static_embedding(static_ids + self.static_embedding_offsets)
 
-        ##Embedding and variable selection
-        static_embedding = torch.cat(embedding_vectors, dim=1)
-        embeddings_encoder = self.apply_embedding(x['inputs'][:,:self.encode_length,:].float().to(self.device), static_embedding, apply_masking=False)
-        embeddings_decoder = self.apply_embedding(x['inputs'][:,self.encode_length:,:].float().to(self.device), static_embedding, apply_masking=True)
-        embeddings_encoder, encoder_sparse_weights = self.encoder_variable_selection(embeddings_encoder[:,:,:-(self.embedding_dim*self.static_variables)],embeddings_encoder[:,:,-(self.embedding_dim*self.static_variables):])
-        embeddings_decoder, decoder_sparse_weights = self.decoder_variable_selection(embeddings_decoder[:,:,:-(self.embedding_dim*self.static_variables)],embeddings_decoder[:,:,-(self.embedding_dim*self.static_variables):])
+        ##the static context is kept as (batch, 1, features) and broadcast over time by the context layers,
+        ##so its projection is computed once per sample rather than once per timestep
+        static_embedding = static_embedding.reshape(static_ids.size(0), 1, -1)
 
-        
-        pe = self.position_encoding(torch.zeros(self.seq_length, 1, embeddings_encoder.size(2)).to(self.device)).to(self.device)
-        
-        embeddings_encoder = embeddings_encoder+pe[:self.encode_length,:,:]
-        embeddings_decoder = embeddings_decoder+pe[self.encode_length:,:,:]
+        with torch.autocast(device_type=self._h0.device.type, dtype=torch.bfloat16, enabled=autocast_enabled):
+            ##Embedding and variable selection
+            embeddings_encoder = self.apply_embedding(x['inputs'][:,:self.encode_length,:].float(), apply_masking=False)
+            embeddings_decoder = self.apply_embedding(x['inputs'][:,self.encode_length:,:].float(), apply_masking=True)
+            embeddings_encoder, encoder_sparse_weights = self.encoder_variable_selection(embeddings_encoder, static_embedding)
+            embeddings_decoder, decoder_sparse_weights = self.decoder_variable_selection(embeddings_decoder, static_embedding)
 
-        ##LSTM
-        lstm_input = torch.cat([embeddings_encoder,embeddings_decoder], dim=0)
-        encoder_output, hidden = self.encode(embeddings_encoder)
-        decoder_output, _ = self.decode(embeddings_decoder, hidden)
-        lstm_output = torch.cat([encoder_output, decoder_output], dim=0)
+            ##encoding of a zero input is just the registered table, so read it directly instead of rebuilding it every step
+            pe = self.position_encoding.pe[:, :self.seq_length]
 
-        ##skip connection over lstm
-        lstm_output = self.post_lstm_gate(lstm_output+lstm_input)
+            ##add the positional encoding in place on the concatenated input rather than to each half before concatenating
+            lstm_input = torch.cat([embeddings_encoder,embeddings_decoder], dim=1).add_(pe)
 
-        ##static enrichment
-        static_embedding = torch.cat(lstm_output.size(0)*[static_embedding]).view(lstm_output.size(0), lstm_output.size(1), -1)   
-        attn_input = self.static_enrichment(lstm_output, static_embedding)
+        return lstm_input, static_embedding, encoder_sparse_weights, decoder_sparse_weights
 
-        ##skip connection over lstm
-        attn_input = self.post_lstm_norm(lstm_output)
+    def run_lstm(self, lstm_input, autocast_enabled):
+        hidden = self.init_hidden()
+        with torch.autocast(device_type=self._h0.device.type, dtype=torch.bfloat16, enabled=autocast_enabled):
+            lstm_output, _ = self.lstm(lstm_input, (hidden, hidden))
+        return lstm_output
 
-        #attn_input = self.position_encoding(attn_input)
+    def decode_outputs(self, lstm_input, lstm_output, static_embedding, need_weights, autocast_enabled):
+        ##everything after the LSTM: gating, static enrichment, attention and the output layers
+        with torch.autocast(device_type=self._h0.device.type, dtype=torch.bfloat16, enabled=autocast_enabled):
+            ##skip connection over lstm
+            lstm_output = self.post_lstm_gate(lstm_output+lstm_input)
 
-        ##Attention
-        attn_output, attn_output_weights = self.multihead_attn(attn_input[self.encode_length:,:,:], attn_input[:self.encode_length,:,:], attn_input[:self.encode_length,:,:])
+            ##static enrichment
+            attn_input = self.static_enrichment(lstm_output, static_embedding)
 
-        ##skip connection over attention
-        attn_output = self.post_attn_gate(attn_output) + attn_input[self.encode_length:,:,:]
-        attn_output = self.post_attn_norm(attn_output)
+            ##skip connection over lstm
+            attn_input = self.post_lstm_norm(lstm_output)
 
-        output = self.pos_wise_ff(attn_output) #[self.encode_length:,:,:])
+            #attn_input = self.position_encoding(attn_input)
 
-        ##skip connection over Decoder
-        output = self.pre_output_gate(output) + lstm_output[self.encode_length:,:,:]
+            ##Attention
+            attn_output, attn_output_weights = self.multihead_attn(attn_input[:,self.encode_length:,:], attn_input[:,:self.encode_length,:], need_weights=need_weights)
+
+            ##skip connection over attention
+            attn_output = self.post_attn_gate(attn_output, attn_input[:,self.encode_length:,:])
+            attn_output = self.post_attn_norm(attn_output)
+
+            output = self.pos_wise_ff(attn_output)
+
+            ##skip connection over Decoder
+            output = self.pre_output_gate(output, lstm_output[:,self.encode_length:,:])
+
+            #Final output layers
+            output = self.pre_output_norm(output)
+        output = self.output_layer(output.float())
+
+        return output, attn_output, attn_output_weights
+
+    def forward(self, x, need_weights=True):
+
+        ##x is a batch dict already on the model's device, see batch_to_device
+        ##need_weights=False skips materialising the attention weights (returned as None), e.g. in the training loop
+
+        ##Embedding, LSTM and attention run under bf16 autocast on bf16-capable GPUs; the output layer stays in float32
+        autocast_enabled = self.autocast_enabled()
+
+        ##split around the LSTM, which torch.compile cannot trace: under compile_forward the LSTM runs eagerly
+        ##and the code on either side of it compiles to one graph each
+        lstm_input, static_embedding, encoder_sparse_weights, decoder_sparse_weights = self.embed_inputs(x, autocast_enabled)
+        lstm_output = self.run_lstm(lstm_input, autocast_enabled)
+        encoder_output = lstm_output[:,:self.encode_length,:]
+        decoder_output = lstm_output[:,self.encode_length:,:]
+        output, attn_output, attn_output_weights = self.decode_outputs(lstm_input, lstm_output, static_embedding, need_weights, autocast_enabled)
 
-        #Final output layers
-        output = self.pre_output_norm(output)
-        output = self.output_layer(output.view(self.batch_size, -1, self.hidden_size))
-        
-        
         return  output,encoder_output, decoder_output, attn_output, attn_output_weights, encoder_sparse_weights, decoder_sparse_weights
-    
-        
-        
\ No newline at end of file
+
+
+class CUDAGraphInference:
+    ## Runs TFT's eval-mode forward as a captured CUDA graph, for batches of one fixed shape on a CUDA model
+    ## The first call warms the model up on a side stream and captures the graph; later calls copy the new
+    ## batch into the captured input tensors and replay the graph, so none of the small kernels go through Python
+    ## The returned tensors are overwritten by each replay, clone them if they need to outlive the next call
+    ## Every batch must match the shape and dtype of the first one (e.g. use DataLoader(drop_last=True))
+    ## need_weights=False captures the fused SDPA attention path and returns None for the attention weights
+    def __init__(self, model, need_weights=True, warmup_steps=3):
+        self.model = model
+        self.need_weights = need_weights
+        self.warmup_steps = warmup_steps
+        self.graph = None
+        self.static_inputs = None
+        self.static_outputs = None
+
+    def capture(self, x):
+        for k in ('inputs', 'identifier'):
+            if not x[k].is_cuda:
+                raise ValueError('CUDA graph capture needs the batch on a CUDA device, but batch {} is on {}; move it with batch_to_device first'.format(
+                    k, x[k].device))
+
+        ##the graph is captured in eval mode; the caller's train/eval mode is restored afterwards
+        was_training = self.model.training
+        self.model.eval()
+        self.static_inputs = {k: x[k].clone() for k in ('inputs', 'identifier')}
+
+        ##warm up on a side stream so lazy initialisation and the scripted fusions happen before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(self.warmup_steps):
+                self.model(self.static_inputs, need_weights=self.need_weights)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(self.graph):
+            self.static_outputs = self.model(self.static_inputs, need_weights=self.need_weights)
+        self.model.train(was_training)
+
+    def __call__(self, x):
+        if self.graph is None:
+            self.capture(x)
+        else:
+            for k, v in self.static_inputs.items():
+                ##copy_ would silently broadcast a smaller batch into every captured row
+                if x[k].shape != v.shape or x[k].dtype != v.dtype:
+                    raise ValueError('Batch {} has shape {} and dtype {}, but the graph was captured for shape {} and dtype {}'.format(
+                        k, tuple(x[k].shape), x[k].dtype, tuple(v.shape), v.dtype))
+            for k, v in self.static_inputs.items():
+                v.copy_(x[k], non_blocking=True)
+        self.graph.replay()
+        return self.static_outputs